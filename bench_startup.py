@@ -0,0 +1,46 @@
+#!env python
+"""Time how long the command line tools take to start up.
+
+Each command is run repeatedly in a fresh interpreter and the best and mean
+wall-clock times are reported, alongside a bare interpreter for reference.
+
+Usage: bench_startup.py [repeats]
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+commands = [
+    ("python (baseline)", ["-c", "pass"]),
+    ("catalog_to_stamps.py --help", ["catalog_to_stamps.py", "--help"]),
+    ("fits_extract.py", ["fits_extract.py"]),
+    ("import tilemaker", ["-c", "import tilemaker"]),
+    ("import catalog_to_stamps", ["-c", "import catalog_to_stamps"]),
+]
+
+
+def time_command(args, repeats):
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeats):
+            start = time.time()
+            subprocess.call([sys.executable] + args, cwd=here,
+                            stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return min(timings), sum(timings) / len(timings)
+
+
+def main(argv):
+    repeats = int(argv[1]) if len(argv) > 1 else 10
+    print("%-32s %10s %10s" % ("command", "best (ms)", "mean (ms)"))
+    for name, args in commands:
+        best, mean = time_command(args, repeats)
+        print("%-32s %10.1f %10.1f" % (name, best * 1000, mean * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -2,19 +2,15 @@
 from __future__ import print_function
 import argparse
 import sys
-import pandas as pd
 import time
 import os
+import re
 import glob
-import astropy.io.fits as pyfits
-import h5py
 import random
 import warnings
 import traceback
-import numpy as np
 
 from tilemaker import find_tiles, make_cuts
-from getfile import download_file
 from shutil import copyfile
 from multiprocessing import Process, Manager
 
@@ -26,10 +22,6 @@ delete_fits = [True]
 
 symbols = "!@#$%^&*()-=_+[]{}\|,./<>?"
 
-tiles = pd.read_csv(
-    os.path.dirname(os.path.realpath(__file__)) + "/y3a1tiles.csv",
-    index_col="TILENAME")
-
 
 def progbar(current, to, width=40, show=True, message=None):
     try:
@@ -49,7 +41,8 @@ def progbar(current, to, width=40, show=True, message=None):
 
 
 class StampWorker(object):
-    def __init__(self, rank, name, catalog, datastore, datamap, dimension):
+    def __init__(self, rank, name, catalog, datastore, datamap, dimension,
+                 rows=None):
         self.datamap = datamap
         self.rank = rank
         self.name = name
@@ -60,6 +53,7 @@ class StampWorker(object):
         self.problem_tiles = {}
         self.complete_tiles = []
         self.dimension = dimension
+        self.rows = rows or {}
 
     def printlog(self, logstring):
         if verbose[0]:
@@ -74,6 +68,8 @@ class StampWorker(object):
         return self.tile_list.pop()
 
     def run(self, delay):
+        import astropy.io.fits as pyfits
+
         datamap = self.datamap
         time.sleep(delay)
         self.printlog("Starting " + self.name)
@@ -119,7 +115,8 @@ class StampWorker(object):
                         headers=hd,
                         catmeta=catmeta,
                         masks=masks,
-                        logfile="logfile_" + str(self.rank) + ".log")
+                        logfile="logfile_" + str(self.rank) + ".log",
+                        rows=self.rows.get(tile_to_process))
 
                     self.printlog("Made cuts successfully.")
                     datamap['bad_objects'].extend(results['bad_objects'])
@@ -169,6 +166,11 @@ def main(argv):
         '--no-cleanup',
         help="Don't remove fits files after processing.",
         action="store_true")
+    parser.add_argument(
+        '--update',
+        help="Add new and failed objects to the existing datastores for " +
+        "their tiles; only tiles not yet stored go into new files.",
+        action="store_true")
 
     parser.add_argument(
         '--verbose',
@@ -185,6 +187,8 @@ def main(argv):
     parser.add_argument("batches", type=int, help="Number of batches to run.")
     parser.add_argument("datastore_prefix", help="Name of output data file.")
     args = parser.parse_args()
+    if args.update and args.flatten:
+        parser.error("--update can't be used with --flatten.")
 
     dimension = args.dimension
 
@@ -203,51 +207,77 @@ def main(argv):
     procs = args.processes
     start_index = 1
     while True:
-        if os.path.exists(dstore_prefix + "_" + str(start_index) + ".hdf5"):
+        if os.path.exists("%s_%0.3d.hdf5" % (dstore_prefix, start_index)):
             start_index += 1
         else:
             break
 
+    import pandas as pd
+    from tileindex import load_index
+
     copyfile(catalog_file, catalog_file + ".bak")
     catalog = pd.read_csv(
         catalog_file, quotechar='"', index_col='COADD_OBJECT_ID')
     catalog = catalog[catalog.TILENAME != "NONE"]
 
-    catalog_toproc = catalog[catalog.STATUS == 'new']
+    if args.update:
+        catalog_toproc = catalog[catalog.STATUS.isin(['new', 'failed'])]
+    else:
+        catalog_toproc = catalog[catalog.STATUS == 'new']
+
+    # Load the tile table before forking so the workers share it
+    load_index()
     tilegroups = catalog_toproc.groupby(by="TILENAME")
     tilegroups = tilegroups.size().sort_values(ascending=False)
     tilenames = tilegroups.index.values
 
+    # Each job is a datastore and the objects to add to it
+    jobs = []
+    if args.update:
+        # Start new files after the last existing one, not in a gap
+        existing = numbered_datastores(dstore_prefix)
+        if existing:
+            start_index = max(start_index, existing[-1][0] + 1)
+        stored = find_datastores(dstore_prefix)
+        tile_stores = catalog_toproc.TILENAME.map(stored)
+        for dstore_name in sorted(set(stored.values())):
+            tilebatch = catalog_toproc[tile_stores == dstore_name]
+            if len(tilebatch) > 0:
+                jobs.append((dstore_name, tilebatch))
+        tilenames = [t for t in tilenames if t not in stored]
+    for b in range(batches):
+        start = b * batch_size
+        end = start + batch_size
+        tilebatch = catalog_toproc[catalog_toproc.TILENAME.isin(tilenames[
+            start:end])]
+        if args.update and len(tilebatch) == 0:
+            break
+        dstore_name = "%s_%0.3d.hdf5" % (dstore_prefix, start_index + b)
+        assert dstore_name not in [job[0] for job in jobs]
+        jobs.append((dstore_name, tilebatch))
+
     # Start the processes
     manager = Manager()
     results_dict = {}
     b = 0
-    while b < batches:
-        print("\nBatch %d/%d." % (1 + (b/procs), batches))
+    while b < len(jobs):
+        print("\nBatch %d/%d." % (1 + b // procs,
+                                   (len(jobs) + procs - 1) // procs))
         proc_handles = []
         for p in range(procs):
-            if b >= batches:
+            if b >= len(jobs):
                 break
+            dstore_name, tilebatch = jobs[b]
             batch_dict = manager.dict()
-            dstore_name = "%s_%0.3d.hdf5" % (dstore_prefix, start_index)
             results_dict[dstore_name] = batch_dict
-            start = b * batch_size
-            # start = ((b * p) + p) * batch_size
-            end = start + batch_size
-            tilebatch = catalog_toproc[catalog_toproc.TILENAME.isin(tilenames[
-                start:end])]
 
-            try:
-                proc = Process(
-                    target=main_batch,
-                    args=(tilebatch, dstore_name, p, args.flatten, dimension,
-                          batch_dict))
-                proc.start()
-                proc_handles.append(proc)
-                b += 1
-                start_index += 1
-            except StopIteration:
-                break
+            proc = Process(
+                target=main_batch,
+                args=(tilebatch, dstore_name, p, args.flatten, dimension,
+                      batch_dict))
+            proc.start()
+            proc_handles.append(proc)
+            b += 1
         while proc_handles:
             proc = proc_handles.pop()
             proc.join()
@@ -265,6 +295,9 @@ def main(argv):
 
 
 def main_batch(catalog, dstore, rank, flatten, dimension, results_dict):
+    import h5py
+    import numpy as np
+
     if verbose[0]:
         print("\nMaking stamps from %d tiles into datastore %s on core %d" %
           (len(catalog.TILENAME.unique()), dstore, rank+1))
@@ -295,27 +328,28 @@ def main_batch(catalog, dstore, rank, flatten, dimension, results_dict):
     tilegroups = tilegroups.size().sort_values(ascending=False)
     tilenames = tilegroups.index.values
 
-
+    rows = {}
     for i in range(len(tilenames)):
         tilename = tilenames[i]
         groupsize = tilegroups.iloc[i]
-        if not flatten:
-            datastore.create_dataset(
-                "/stamps/%s/data" % (tilename),
-                (groupsize, dimension, dimension, 5),
-                dtype='f4')
-            datastore.create_dataset(
-                "/stamps/%s/masks" % (tilename), (groupsize, 5),
-                dtype=np.int32)
-            datastore.create_dataset(
-                "/stamps/%s/header" % (tilename), (groupsize, 5),
-                dtype="S9000")
-            datastore.create_dataset(
-                "/stamps/%s/catalog" % (tilename), (groupsize, ), dtype='S30')
+        if flatten:
+            continue
+        group = "/stamps/%s" % (tilename)
+        if group not in datastore:
+            create_tile_datasets(datastore, tilename, groupsize, dimension)
+        restore_tile_datasets(datastore[group])
+        if datastore[group + "/data"].shape[1] != dimension:
+            print("Tile %s in %s has stamps of a different size. Skipping." %
+                  (tilename, dstore))
+            results_dict['failed_tiles'] += [tilename]
+            catalog = catalog[catalog.TILENAME != tilename]
+        else:
+            rows[tilename] = append_rows(
+                datastore[group], catalog[catalog.TILENAME == tilename].index)
 
     datamap = {"bad_objects": [], "failed_tiles": [], "done_tiles": []}
     worker = StampWorker(rank, "Worker" + str(rank), catalog, datastore,
-                         datamap, dimension)
+                         datamap, dimension, rows)
     worker.run(random.randint(1, 10))
     datastore.close()
 
@@ -324,7 +358,138 @@ def main_batch(catalog, dstore, rank, flatten, dimension, results_dict):
     results_dict['done_tiles'] += datamap['done_tiles']
 
 
+def tile_dataset_layout(dimension):
+    """Row shape, dtype and chunk shape of each of a tile's datasets."""
+    import numpy as np
+
+    return {
+        "data": ((dimension, dimension, 5), 'f4', (1, dimension, dimension, 1)),
+        "masks": ((5, ), np.int32, True),
+        "header": ((5, ), "S9000", (1, 1)),
+        "catalog": ((), 'S30', True),
+    }
+
+
+def create_tile_datasets(datastore, tilename, groupsize, dimension):
+    """Create the datasets for a tile, resizable so objects can be added."""
+    layout = tile_dataset_layout(dimension)
+    for name in ["data", "masks", "header", "catalog"]:
+        row_shape, dtype, chunks = layout[name]
+        datastore.create_dataset(
+            "/stamps/%s/%s" % (tilename, name), (groupsize, ) + row_shape,
+            maxshape=(None, ) + row_shape, chunks=chunks, dtype=dtype)
+
+
+def restore_tile_datasets(group):
+    """Finish or roll back grow_dataset copies that were interrupted."""
+    for name in ["data", "masks", "header", "catalog"]:
+        tmp = name + "_resizable"
+        if tmp not in group:
+            continue
+        if name in group:
+            del group[tmp]  # Copy never completed; the original is intact
+        else:
+            group.move(tmp, name)
+
+
+def grow_dataset(group, name, size, dimension, block=1000):
+    """Make sure group[name] has at least size rows.
+
+    Datasets written before tiles were resizable are copied into a new
+    resizable dataset, which then replaces the original. HDF5 doesn't free
+    the space of the old dataset; run h5repack on the file to reclaim it.
+    """
+    ds = group[name]
+    if ds.shape[0] >= size:
+        return
+    if ds.maxshape[0] is None:
+        ds.resize(size, axis=0)
+        return
+
+    row_shape, _, chunks = tile_dataset_layout(dimension)[name]
+    tmp = name + "_resizable"
+    new = group.create_dataset(
+        tmp, (size, ) + row_shape, maxshape=(None, ) + row_shape,
+        chunks=chunks, dtype=ds.dtype)
+    for start in range(0, ds.shape[0], block):
+        end = min(start + block, ds.shape[0])
+        new[start:end] = ds[start:end]
+    group.file.flush()
+    del group[name]
+    group.move(tmp, name)
+
+
+def append_rows(group, objids):
+    """Assign each object a row in a tile group.
+
+    Objects already stored keep their row and are overwritten, others fill
+    rows that were never written and then go on the end. The tile's
+    datasets are grown to fit. Used for new tile groups too, so every tile
+    is written the same way. Returns a dict of object id to row.
+    """
+    stored = [o.decode() if isinstance(o, bytes) else o
+              for o in group["catalog"][...]]
+    stored = [o.strip() for o in stored]
+    existing = dict((o, i) for i, o in enumerate(stored) if o)
+    free = [i for i, o in enumerate(stored) if not o]
+    free.reverse()
+
+    size = len(stored)
+    rows = {}
+    for objid in objids:
+        if str(objid) in existing:
+            rows[objid] = existing[str(objid)]
+        elif free:
+            rows[objid] = free.pop()
+        else:
+            rows[objid] = size
+            size += 1
+
+    dimension = group["data"].shape[1]
+    for name in ["data", "masks", "header", "catalog"]:
+        grow_dataset(group, name, size, dimension)
+    return rows
+
+
+def numbered_datastores(prefix):
+    """Return (index, filename) for each <prefix>_NNN.hdf5 file, in order."""
+    numbered = re.compile(re.escape(prefix) + r"_(\d{3,})\.hdf5$")
+    dstores = []
+    for dstore in glob.glob(prefix + "_*.hdf5"):
+        match = numbered.match(dstore)
+        if match:
+            dstores.append((int(match.group(1)), dstore))
+    return sorted(dstores)
+
+
+def find_datastores(prefix):
+    """Map each tile already in a <prefix>_NNN.hdf5 file to that file.
+
+    If a tile is split across several files, the first one is used and a
+    warning is printed.
+    """
+    import h5py
+
+    stored = {}
+    for _, dstore in numbered_datastores(prefix):
+        with h5py.File(dstore, 'r') as f:
+            if "stamps" not in f:
+                continue
+            for tile in f["stamps"]:
+                if not isinstance(f["stamps"][tile], h5py.Group):
+                    continue
+                if tile in stored:
+                    print("Warning: tile %s is in both %s and %s; only %s "
+                          "will be updated." % (tile, stored[tile], dstore,
+                                                stored[tile]))
+                    continue
+                stored[tile] = dstore
+    return stored
+
+
 def initialise_datastore(datastore, dimension):
+    import h5py
+
     f = h5py.File(datastore, 'w')
     grp = f.create_group("stamps")
     grp.attrs['description'] = "DES y3a1coadd cutouts, dimensions=%dx%d" % (
@@ -332,16 +497,14 @@ def initialise_datastore(datastore, dimension):
 
 
 def get_tile_files(tile):
-    try:
-        tilefile = tiles.loc[tile, 'FILENAME']
-        tilepath = tiles.loc[tile, 'PATH']
-    except ValueError:
+    from tileindex import load_index
+    from getfile import download_file
+
+    tilefiles = load_index().files(tile)
+    if tilefiles is None:
         print("No file for tile " + tile + ". Abort!")
         return None
-
-    if type(tilefile) != str:  # Use first one from list
-        tilefile = tilefile[0]
-        tilepath = tilepath[0]
+    tilefile, tilepath = tilefiles
 
     filenames = []
     for band in "grizY":
@@ -1,9 +1,6 @@
 #!env python
 import os
 import sys
-import coltools as ct
-import h5py as h5
-import astropy.io.fits as pyfits
 
 
 def fal(filename, skip_comments=True):
@@ -39,9 +36,12 @@ def extract_objects(datastore, objids, outdir):
 
 
 def extract_some(ids, datastore, outdir):
+    import h5py as h5
+    import astropy.io.fits as pyfits
+
     todo = len(ids)
     done = 0
-    ct.progbar(done, todo)
+    progbar(done, todo)
     with h5.File(datastore, "r") as f:
         ds = f['/stamps/']
         for tile in ds:
@@ -53,7 +53,7 @@ def extract_some(ids, datastore, outdir):
                 objid = objids[i].strip()
                 if objid in ids:
                     done += 1
-                    ct.progbar(done, todo)
+                    progbar(done, todo)
                     heads = headers[i]
                     for b in range(5):
                         band_name = "grizY" [b]
@@ -64,11 +64,197 @@ def extract_some(ids, datastore, outdir):
                         outfits.writeto(filename, overwrite=True)
 
 
-def make_rgb(datastore, outdir):
-    pass
+def lupton_rgb(stamps, stretch=5.0, Q=8.0, minimum=0.0):
+    """Make asinh colour composites (Lupton et al. 2004) from a batch of stamps.
+
+    stamps is an N x dim x dim x 3 array with the bands ordered red, green,
+    blue. Returns a uint8 array of the same shape. The mapping follows
+    Lupton et al. 2004 and astropy's make_lupton_rgb, working on the whole
+    batch at once, with some differences from astropy: values are rounded
+    rather than truncated to uint8, negative channels are clipped to zero,
+    and Q is floored at 1e-10 instead of a near-zero Q being replaced by 0.1.
+    """
+    import numpy as np
+
+    image = np.asarray(stamps, dtype=np.float32) - minimum
+    intensity = image.sum(axis=-1, keepdims=True) / 3.0
+    slope = 0.1 * 255 / np.arcsinh(0.1 * max(Q, 1e-10))
+    soften = Q / float(stretch)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = np.where(intensity <= 0, 0,
+                         np.arcsinh(intensity * soften) * slope / intensity)
+    image *= scale
+    image[~np.isfinite(image)] = 0
+    np.clip(image, 0, None, out=image)
+
+    # Scale down saturated pixels so they keep their colour
+    peak = image.max(axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        image *= np.where(peak > 255, 255 / peak, 1)
+    return image.round().astype(np.uint8)
+
+
+def rgb_batches(datastore, ids=None, batch_size=500, stretch=5.0, Q=8.0):
+    """Yield (objids, images) from datastore, batch_size stamps at a time.
+
+    Images are i, r, g composites from lupton_rgb, flipped so north is up.
+    If ids is given, only those objects are rendered. Rows that were never
+    filled (empty object id) are skipped.
+    """
+    import h5py as h5
+
+    if ids is not None:
+        ids = set(ids) - set([""])
+    with h5.File(datastore, "r") as f:
+        ds = f['/stamps/']
+        for tile in ds:
+            data = ds[tile + "/data"]
+            catalog = ds[tile + "/catalog"]
+            N = data.shape[0]
+            for start in range(0, N, batch_size):
+                end = min(start + batch_size, N)
+                objids = [o.decode() if isinstance(o, bytes) else o
+                          for o in catalog[start:end]]
+                objids = [o.strip() for o in objids]
+                keep = [i for i, o in enumerate(objids)
+                        if o and (ids is None or o in ids)]
+                if not keep:
+                    continue
+                # grizY -> i, r, g as red, green, blue
+                stamps = data[start:end, :, :, 0:3][keep, :, :, ::-1]
+                images = lupton_rgb(stamps, stretch=stretch, Q=Q)
+                yield [objids[i] for i in keep], images[:, ::-1]
+
+
+def write_pngs(job):
+    outdir, objids, images = job
+    from PIL import Image
+
+    for objid, image in zip(objids, images):
+        Image.fromarray(image).save("%s/%s.png" % (outdir, objid))
+    return len(objids)
+
+
+def write_atlas(job):
+    filename, images, columns = job
+    import numpy as np
+    from PIL import Image
+
+    n, dim = images.shape[0], images.shape[1]
+    rows = (n + columns - 1) // columns
+    atlas = np.zeros((rows * dim, columns * dim, 3), dtype=np.uint8)
+    for k in range(n):
+        y, x = (k // columns) * dim, (k % columns) * dim
+        atlas[y:y + dim, x:x + dim] = images[k]
+    Image.fromarray(atlas).save(filename)
+    return n
+
+
+def atlas_pages(batches, outdir, columns):
+    """Group rendered batches into atlas pages of columns x columns stamps.
+
+    Yields write_atlas jobs and records each object's page, row and column
+    in outdir/atlas.csv.
+    """
+    import numpy as np
+
+    per_page = columns * columns
+    page_ids, page_images = [], []
+
+    def page_job(page, objids, images):
+        for k, objid in enumerate(objids):
+            index.write("%s,%d,%d,%d\n" % (objid, page, k // columns,
+                                           k % columns))
+        return "%s/atlas_%0.3d.png" % (outdir, page), images, columns
+
+    page = 0
+    with open(outdir + "/atlas.csv", "w") as index:
+        index.write("objid,page,row,column\n")
+        for objids, images in batches:
+            page_ids += objids
+            page_images.append(images)
+            while len(page_ids) >= per_page:
+                images = np.concatenate(page_images)
+                yield page_job(page, page_ids[:per_page], images[:per_page])
+                page_ids, page_images = page_ids[per_page:], [images[per_page:]]
+                page += 1
+        if page_ids:
+            yield page_job(page, page_ids, np.concatenate(page_images))
+
+
+def count_stamps(datastore, ids=None):
+    """Count the filled rows (non-empty object id) in a datastore.
+
+    If ids is given, only rows for those objects are counted.
+    """
+    import h5py as h5
+
+    count = 0
+    with h5.File(datastore, "r") as f:
+        ds = f['/stamps/']
+        for tile in ds:
+            for objid in ds[tile + "/catalog"][...]:
+                if isinstance(objid, bytes):
+                    objid = objid.decode()
+                objid = objid.strip()
+                if objid and (ids is None or objid in ids):
+                    count += 1
+    return count
+
+
+def make_rgb(datastore, outdir, ids=None, atlas=False, columns=20,
+             stretch=5.0, Q=8.0, batch_size=500, processes=None):
+    """Render gri colour thumbnails for the stamps in a datastore.
+
+    By default writes <objid>.png for each object. With atlas=True the
+    thumbnails are tiled into pages of columns x columns stamps
+    (atlas_NNN.png) and atlas.csv records where each object was placed.
+    PNG encoding is spread over a pool of processes.
+    """
+    from multiprocessing import Pool, cpu_count
+
+    if ids is not None:
+        ids = set(ids) - set([""])
+    todo = count_stamps(datastore, ids)
+    if ids is not None and todo < len(ids):
+        print("%d of the requested objects aren't in %s." %
+              (len(ids) - todo, datastore))
+    if todo == 0:
+        print("No stamps to render.")
+        return
+    done = 0
+    progbar(done, todo)
+
+    batches = rgb_batches(datastore, ids, batch_size, stretch, Q)
+    if atlas:
+        jobs = atlas_pages(batches, outdir, columns)
+        encode = write_atlas
+    else:
+        jobs = ((outdir, objids, images) for objids, images in batches)
+        encode = write_pngs
+
+    processes = processes or cpu_count()
+    pool = Pool(processes)
+    pending = []
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(encode, (job, )))
+            # Don't render too far ahead of the encoders
+            while len(pending) > 2 * processes:
+                done += pending.pop(0).get()
+                progbar(done, todo)
+        while pending:
+            done += pending.pop(0).get()
+            progbar(done, todo)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def extract_all(datastore, outdir):
+    import h5py as h5
+    import astropy.io.fits as pyfits
+
     with h5.File(datastore, "r") as f:
         ds = f['/stamps/']
         for tile in ds:
@@ -89,16 +275,21 @@ def extract_all(datastore, outdir):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("image_extract <datastore> <dest_dir> [objids]")
+    args = sys.argv[1:]
+    rgb = "--rgb" in args
+    atlas = "--atlas" in args
+    args = [a for a in args if a not in ("--rgb", "--atlas")]
+
+    if len(args) < 2:
+        print("image_extract [--rgb | --atlas] <datastore> <dest_dir> [objids]")
         sys.exit(0)
 
-    datastore = sys.argv[1]
-    outdir = sys.argv[2]
+    datastore = args[0]
+    outdir = args[1]
 
     inputs = None
-    if len(sys.argv) == 4:
-        inputs = sys.argv[3]
+    if len(args) == 3:
+        inputs = args[2]
 
     if not os.path.exists(outdir):
         print("Output directory doesn't exist.")
@@ -106,10 +297,13 @@ if __name__ == "__main__":
 
 
     if inputs is not None and os.path.exists(inputs):
-        objids = ct.fal(inputs)
+        objids = fal(inputs)
     elif inputs is not None:
         objids = inputs.split(",")
     else:
         objids = None
 
-    extract_objects(datastore, objids, outdir)
+    if rgb or atlas:
+        make_rgb(datastore, outdir, ids=objids, atlas=atlas)
+    else:
+        extract_objects(datastore, objids, outdir)
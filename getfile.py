@@ -1,12 +1,13 @@
-import requests
 import shutil
-from requests.auth import HTTPBasicAuth
 
 username = "username"
 password = "password"
 prefix = "https://desar2.cosmology.illinois.edu/DESFiles/desarchive/"
 
 def download_file(url, user=username, password=password):
+    import requests
+    from requests.auth import HTTPBasicAuth
+
     url = prefix + url
     local_filename = url.split('/')[-1]
     r = requests.get(url, stream=True, auth=HTTPBasicAuth(user, password))
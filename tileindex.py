@@ -0,0 +1,132 @@
+"""Compiled lookup table for the DES tile metadata in y3a1tiles.csv.
+
+Parsing the CSV with pandas is slow, so the columns we need are compiled
+once into a numpy .npz cache next to the CSV. The cache records the mtime
+of the CSV it was built from and is rebuilt if the CSV changes.
+"""
+import os
+import tempfile
+import numpy as np
+
+TILE_CSV = os.path.dirname(os.path.realpath(__file__)) + "/y3a1tiles.csv"
+
+STRING_COLUMNS = ["TILENAME", "FILENAME", "PATH"]
+BOUND_COLUMNS = ["URAMIN", "URAMAX", "UDECMIN", "UDECMAX"]
+
+_index = {}
+
+
+class TileIndex(object):
+    """Tile names, file locations and bounds held as numpy arrays.
+
+    Lookups by tile name go through a dict of row positions; where a tile
+    appears more than once in the CSV the first row is used.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.tilenames = columns['TILENAME']
+        self.filenames = columns['FILENAME']
+        self.paths = columns['PATH']
+        self.uramin = columns['URAMIN']
+        self.uramax = columns['URAMAX']
+        self.udecmin = columns['UDECMIN']
+        self.udecmax = columns['UDECMAX']
+        self.rows = {}
+        for i, tilename in enumerate(self.tilenames):
+            self.rows.setdefault(str(tilename), i)
+
+    def __len__(self):
+        return len(self.tilenames)
+
+    def __contains__(self, tile):
+        return tile in self.rows
+
+    def files(self, tile):
+        """Return (filename, path) for a tile, or None if it is unknown."""
+        row = self.rows.get(tile)
+        if row is None:
+            return None
+        return str(self.filenames[row]), str(self.paths[row])
+
+    def find(self, ra, dec):
+        """Return the row of the first tile containing ra, dec, or -1."""
+        found = np.flatnonzero((self.uramin < ra) & (self.uramax > ra) &
+                               (self.udecmin < dec) & (self.udecmax > dec))
+        if len(found) == 0:
+            return -1
+        return found[0]
+
+
+def cache_name(csv_file):
+    return os.path.splitext(csv_file)[0] + ".npz"
+
+
+def build_index(csv_file, cache_file=None):
+    """Parse the tile CSV and write the compiled columns to cache_file."""
+    import pandas as pd
+
+    tiles = pd.read_csv(csv_file, usecols=STRING_COLUMNS + BOUND_COLUMNS)
+    columns = {}
+    for col in STRING_COLUMNS:
+        columns[col] = np.array(tiles[col].astype(str).tolist(), dtype="U")
+    for col in BOUND_COLUMNS:
+        columns[col] = tiles[col].values.astype(np.float64)
+
+    if cache_file is not None:
+        write_cache(cache_file, os.path.getmtime(csv_file), columns)
+    return TileIndex(columns)
+
+
+def write_cache(cache_file, csv_mtime, columns):
+    """Write the cache to a temporary file and move it into place.
+
+    Readers never see a partly written cache, even if several processes
+    build it at once or the writer is killed.
+    """
+    try:
+        fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(cache_file)), suffix=".tmp")
+    except (IOError, OSError):
+        return  # Read-only install; just use the parsed columns
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, csv_mtime=csv_mtime, **columns)
+        # os.replace is Python 3 only; rename is also atomic on POSIX
+        getattr(os, "replace", os.rename)(tmp_file, cache_file)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def read_cache(cache_file, csv_mtime):
+    """Load the compiled columns, or return None if the cache is stale.
+
+    A cache that can't be read for any reason is treated as stale.
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cache:
+            if float(cache['csv_mtime']) != csv_mtime:
+                return None
+            columns = dict((col, cache[col])
+                           for col in STRING_COLUMNS + BOUND_COLUMNS)
+    except Exception:
+        return None
+    return TileIndex(columns)
+
+
+def load_index(csv_file=TILE_CSV):
+    """Return the TileIndex for csv_file, built at most once per process.
+
+    Worker processes forked after the first call share the parent's copy.
+    """
+    if csv_file in _index:
+        return _index[csv_file]
+    cache_file = cache_name(csv_file)
+    index = read_cache(cache_file, os.path.getmtime(csv_file))
+    if index is None:
+        index = build_index(csv_file, cache_file)
+    _index[csv_file] = index
+    return index
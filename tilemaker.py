@@ -1,18 +1,5 @@
-import numpy as np
-import pandas as pd
-import h5py
-import astropy
 import time
-import os
 import sys
-import astropy.io.fits as pyfits
-from astropy.coordinates import SkyCoord
-from astropy.wcs import WCS
-from astropy.nddata import Cutout2D
-from astropy import units as u
-
-tiles = pd.read_csv(
-    os.path.dirname(os.path.realpath(__file__)) + "/y3a1tiles.csv")
 
 
 def pb(current, to, width=40, show=True, message=None, stderr=False):
@@ -51,9 +38,18 @@ def make_cuts(catalog,
               catmeta=None,
               masks=None,
               logfile=None,
-              results=None):
+              results=None,
+              rows=None):
+    """Given a fits data file, turn WCS into pixels and grab data from tile.
+
+    If rows maps object ids to rows of the output datasets, each cutout is
+    stored in its object's row; otherwise cutouts are stored in order.
+    """
+    import numpy as np
+    from astropy.wcs import WCS
+    from astropy.nddata import Cutout2D
+
     results = dict(bad_objects=[])
-    """Given a fits data file, turn WCS into pixels and grab data from tile."""
     band_idx = "grizY".index(band)
     todo = len(catalog)
     i = 0
@@ -116,11 +112,12 @@ def make_cuts(catalog,
                     1]] = cutout.data
                 cutout.data = zeros
 
-            data[j, :, :, band_idx] = cutout.data
+            row = j if rows is None else rows[objids[j]]
+            data[row, :, :, band_idx] = cutout.data
             if masks is not None:
-                masks[j, band_idx] = mask_sums[j]
-            headers[j, band_idx] = head.tostring().ljust(9000, ' ')
-            catmeta[j] = str(objids[j]).ljust(30, ' ')
+                masks[row, band_idx] = mask_sums[j]
+            headers[row, band_idx] = head.tostring().ljust(9000, ' ')
+            catmeta[row] = str(objids[j]).ljust(30, ' ')
             # print(" %d/%d " % (j, todo))
         if j % 50 == 0:
             log_to_file(logfile,
@@ -141,21 +138,26 @@ def extract_stamp(datastore, tile, objid, filename):
 
 def write_cut(cutout, filename, tile, head):
     """Save a cutout to the filesystem as a fits file."""
+    import astropy.io.fits as pyfits
+
     outfits = pyfits.PrimaryHDU(data=cutout.data, header=head)
     outfits.writeto(filename, overwrite=True)
 
 
 def find_tiles_reverse(catalog):
     """Lookup the tile name given an RA, DEC pair."""
+    from tileindex import load_index
+
+    tiles = load_index()
 
-    N = len(tiles.index)
+    N = len(tiles)
     i = 0
     catalog['TILENAME'] = "NONE"
     catalog['STATUS'] = "new"
-    for tile in tiles[["URAMIN", "URAMAX", "UDECMIN", "UDECMAX",
-                       "TILENAME"]].itertuples():
+    for tile in zip(tiles.uramin, tiles.uramax, tiles.udecmin,
+                    tiles.udecmax, tiles.tilenames):
         pb(i + 1, N)
-        idx, ramin, ramax, decmin, decmax, tilename = tile
+        ramin, ramax, decmin, decmax, tilename = tile
 
         if ramin > ramax:
             found = catalog[((catalog.RA > ramin) | (catalog.RA < ramax)) &
@@ -169,6 +171,9 @@ def find_tiles_reverse(catalog):
 
 def find_tiles(catalog):
     """For a list of ra/dec pairs, find a tile that they are located in."""
+    from tileindex import load_index
+
+    tiles = load_index()
     i = 0
     length = len(catalog)
     catalog['TILENAME'] = "---"
@@ -176,18 +181,17 @@ def find_tiles(catalog):
     for row in catalog[['RA', 'DEC']].itertuples():
         pb(i + 1, length)
         idx, ra, dec = row
-        if last_tile is not None and (last_tile.URAMIN < ra) and (last_tile.URAMAX > ra) and\
-                (last_tile.UDECMIN < dec) and (last_tile.UDECMAX > dec):
-            catalog.loc[idx, 'TILENAME'] = last_tile.TILENAME
+        if last_tile is not None and (tiles.uramin[last_tile] < ra) and (tiles.uramax[last_tile] > ra) and\
+                (tiles.udecmin[last_tile] < dec) and (tiles.udecmax[last_tile] > dec):
+            catalog.loc[idx, 'TILENAME'] = tiles.tilenames[last_tile]
             continue
 
-        found = tiles[(tiles.URAMIN < ra) & (tiles.URAMAX > ra) &
-                      (tiles.UDECMIN < dec) & (tiles.UDECMAX > dec)]
-        if len(found) == 0:
+        found = tiles.find(ra, dec)
+        if found < 0:
             catalog.loc[idx, 'TILENAME'] = "NONE"
         else:
-            catalog.loc[idx, 'TILENAME'] = found.iloc[0].TILENAME
-            last_tile = found.iloc[0]
+            catalog.loc[idx, 'TILENAME'] = tiles.tilenames[found]
+            last_tile = found
         i += 1
 
 
@@ -196,6 +200,8 @@ if __name__ == "__main__":
 
     Usage: tilemaker.py <input cat> <output filename>
     """
+    import pandas as pd
+
     catalog = pd.read_csv(sys.argv[1], index_col="COADD_OBJECT_ID")
     find_tiles_reverse(catalog)
     catalog.to_csv(sys.argv[2])